@@ -9,22 +9,36 @@ TO DO:
 
 """
 from string import Template
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import csv
+import functools
+import queue
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from email.message import EmailMessage
 import random
+import sys
 import argparse
 from getpass import getpass
-from typing import Set, List
+from typing import Set, List, Tuple
 from datetime import datetime
 
 
 CURRENT_YEAR = datetime.now().date().strftime("%Y")
 EMAIL_SUBJECT = f'Secret Santa {CURRENT_YEAR}'
 
+# Default generator for all draws. A private instance avoids the lock around the
+# random module's global singleton, and callers (tests in particular) can pass
+# their own seeded random.Random instead of seeding global state.
+_rng = random.Random()
 
+
+@functools.lru_cache(maxsize=16)
 def read_template(filename: str) -> Template:
-    """ Reads string template from file """
+    """ Reads string template from file
+    Results are cached, so constructing several Messages from the same template
+    file only reads it once. Template objects are immutable, sharing is safe.
+    """
     with open(filename, 'r') as template_file:
         template_file_content = template_file.read()
     return Template(template_file_content)
@@ -33,20 +47,31 @@ def read_template(filename: str) -> Template:
 def get_people(filename: str) -> Set:
     """ Function to read the contacts from a given contact file and return a list of names and
     email addresses """
-    people = set()
-    with open(filename, mode='r') as contacts_file:
-        for a_contact in contacts_file:
-            name, email, gender, restrictions = [col.strip() for col in a_contact.split(',')]
-            restrictions = set(restrictions.split(';') + [name])
-            if '' in restrictions:
-                restrictions.remove('')
-            people.add(Person(name=name, email=email, gender=gender, restrictions=restrictions))
-
-    return people
+    people = []
+    with open(filename, mode='r', newline='') as contacts_file:
+        for row in csv.reader(contacts_file, skipinitialspace=True):
+            name, email, gender, restrictions = [col.strip() for col in row]
+            restrictions = set(filter(None, restrictions.split(';'))) | {name}
+            people.append(Person(name=name, email=email, gender=gender,
+                                 restrictions=restrictions))
+
+    # Convert names to integer ids once at ingestion; the draw algorithms then
+    # never have to hash a string. Restrictions naming nobody in the file are
+    # dropped here, as they could never match anyway.
+    name_to_id = {pers.name: i for i, pers in enumerate(people)}
+    for i, pers in enumerate(people):
+        pers.id = i
+        pers.restrictions_ids = frozenset(
+            name_to_id[name] for name in pers.restrictions if name in name_to_id)
+
+    return set(people)
 
 
 class Person:
     """ Person class """
+    __slots__ = ('name', 'email', 'gender', 'restrictions', 'secret_santa',
+                 'id', 'restrictions_ids')
+
     def __init__(self, name: str, email: str = None, gender: str = None,
                  restrictions: Set[str] = None):
         """ Constructor
@@ -56,23 +81,13 @@ class Person:
         :param restrictions: Set of restrictions.
             If None, it is set to empty list
         """
-        self.name = name
+        self.name = sys.intern(name)
         self.email = email
         self.gender = gender
         self.restrictions = restrictions if restrictions is not None else []
-        self._secret_santa = None
-
-    @property
-    def secret_santa(self):
-        """ Returns secret santa Person object"""
-        return self._secret_santa
-
-    def set_secret_santa(self, secret_santa):
-        """ Sets secret santa
-        :param secret_santa: Person
-            Secret santa object
-        """
-        self._secret_santa = secret_santa
+        self.secret_santa = None
+        self.id = None
+        self.restrictions_ids = None
 
     def __str__(self):
         """ Returns name str """
@@ -82,92 +97,308 @@ class Person:
 class Messages:
     """ Messages class
     Handles sending of messages by e-mail """
-    def __init__(self, sender: str, msg_template: str, interactive: bool = False):
+    def __init__(self, sender: str, msg_template: str, interactive: bool = False,
+                 max_workers: int = 8):
         """ Constructor
         :param sender: Sender e-mail
         :param msg_template: Message template file path
         :param interactive: Sets interactive mode
+        :param max_workers: Maximum number of concurrent SMTP connections
         """
         self.sender = sender
         self.interactive = interactive
-        self.server = None
-        self.template = read_template(msg_template)
+        self.max_workers = max_workers
+        self._password = None
+        self._connections = queue.Queue()
+        # Translate the template into a str.format string once; Template.substitute
+        # would re-parse the placeholders with a regex on every send
+        text = read_template(msg_template).template.replace('{', '{{').replace('}', '}}')
+        text = text.replace('${{PERSON_NAME}}', '{name}').replace('$PERSON_NAME', '{name}')
+        text = text.replace('${{SECRET_SANTA}}', '{santa}').replace('$SECRET_SANTA', '{santa}')
+        self._fmt = text.format_map
+        # Message skeleton shared by all recipients; only To and the body change
+        self._base_msg = EmailMessage()
+        self._base_msg['From'] = sender
+        self._base_msg['Subject'] = EMAIL_SUBJECT
         self.set_up()
 
     def set_up(self):
-        """ Set up the SMTP server """
-        self.server = smtplib.SMTP(host='smtp-mail.outlook.com')
-        self.server.starttls()
-        self.server.login(self.sender, getpass())
+        """ Asks for the password and opens the first SMTP connection """
+        self._password = getpass()
+        self._connections.put(self._connect())
+
+    def _connect(self):
+        """ Returns a new logged-in SMTP connection """
+        server = smtplib.SMTP(host='smtp-mail.outlook.com')
+        server.starttls()
+        server.login(self.sender, self._password)
+        return server
+
+    def _acquire(self):
+        """ Takes a connection from the pool, opening a new one if none is free """
+        try:
+            return self._connections.get_nowait()
+        except queue.Empty:
+            return self._connect()
 
     def send(self, people: List[Person]):
-        """ Send e-mail to each person """
-        for person in people:
-            print('Sending to %s (%s)' % (person.name, person.email))
-            if self.interactive:
-                input("Press Enter to send...")
+        """ Send e-mail to each person
+        Interactive mode sends sequentially, waiting for confirmation before each
+        e-mail; otherwise sends are spread over a pool of SMTP connections so the
+        total time is not one network round trip per person.
+        """
+        if self.interactive:
+            for person in people:
+                input("Press Enter to send to %s..." % person.name)
+                self._send(person)
+            return
 
-            self._send(person)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._send, person) for person in people]
+            for future in futures:
+                future.result()
 
     def _send(self, person: Person):
         """Send e-mail to person
 
         :param person: Person object
         """
-        msg = MIMEMultipart()  # create a message
+        print('Sending to %s (%s)' % (person.name, person.email))
 
         # add in the actual person name to the message template
-        message = self.template.substitute(
-            PERSON_NAME=person.name,
-            SECRET_SANTA=person.secret_santa.name
-        )
+        message = self._fmt({'name': person.name, 'santa': person.secret_santa.name})
 
-        # set up the parameters of the message
-        msg['From'] = self.sender
+        # clone the prepared skeleton and fill in the recipient-specific parts
+        msg = copy.deepcopy(self._base_msg)
         msg['To'] = person.email
-        msg['Subject'] = EMAIL_SUBJECT
+        msg.set_content(message)
+
+        # send the message via a pooled connection
+        server = self._acquire()
+        try:
+            try:
+                server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # The server drops connections left idle, e.g. while interactive
+                # mode waits for confirmation; log in again and retry once
+                server = self._connect()
+                server.send_message(msg)
+        finally:
+            self._connections.put(server)
+
+
+def index_people(people: Set[Person]) -> Tuple[List[Person], List[int], List[int]]:
+    """ Assigns an index in 0..n-1 to each person and builds restriction bitmasks
+    :param people: Set of Person
+    :return: Tuple (persons, restrictions_mask, allowed_mask) where persons is a list
+        of Person, restrictions_mask[i] has bit j set when persons[j] cannot be the
+        secret santa of persons[i] (bit i is always set so nobody draws themselves)
+        and allowed_mask[i] is its complement over the n used bits
+    """
+    persons = list(people)
+    if all(pers.id is not None for pers in persons):
+        persons.sort(key=lambda pers: pers.id)
+    if all(pers.id == i for i, pers in enumerate(persons)):
+        # Ids were assigned at ingestion (get_people) and cover this whole set:
+        # build masks from them directly, without touching any name string
+        restrictions_mask = []
+        for pers in persons:
+            mask = 1 << pers.id
+            for j in pers.restrictions_ids:
+                mask |= 1 << j
+            restrictions_mask.append(mask)
+    else:
+        index = {pers.name: i for i, pers in enumerate(persons)}
+        restrictions_mask = []
+        for i, pers in enumerate(persons):
+            mask = 1 << i
+            for name in pers.restrictions:
+                j = index.get(name)
+                if j is not None:
+                    mask |= 1 << j
+            restrictions_mask.append(mask)
+
+    full = (1 << len(persons)) - 1
+    allowed_mask = [full & ~mask for mask in restrictions_mask]
+
+    return persons, restrictions_mask, allowed_mask
+
+
+def brute_force_draw(people: Set[Person], rng: random.Random = None):
+    """Performs draw by random shuffling:
+    - Shuffles indices so person i gives to perm[i]
+    - Repairs restriction violations by swapping with a compatible position
+    Secret santas are only assigned once the whole permutation is valid, so a
+    failed attempt never leaves partial assignments behind.
+    :param people: People to be drawn
+    :param rng: Random generator to draw with, module default if None
+    :return: People with secret santa attribute assigned
+    """
+    if rng is None:
+        rng = _rng
+    persons, restrictions_mask, _ = index_people(people)
+    perm = list(range(len(persons)))
+    while True:
+        rng.shuffle(perm)
+        if _repair(perm, restrictions_mask):
+            break
+
+    for giver, receiver in enumerate(perm):
+        persons[giver].secret_santa = persons[receiver]
 
-        # add in the message body
-        msg.attach(MIMEText(message, 'plain'))
+    return people
 
-        # send the message via the server set up earlier.
-        self.server.send_message(msg)
 
-        del msg
+def _repair(perm: List[int], restrictions_mask: List[int]) -> bool:
+    """ Fixes restriction violations in a permutation by swapping receivers
+    :param perm: Permutation mapping giver index to receiver index, fixed in place
+    :param restrictions_mask: Restriction bitmasks built by index_people
+    :return: True if every position could be repaired, False otherwise
+    """
+    n = len(perm)
+    for i in range(n):
+        mask_i = restrictions_mask[i]
+        if not mask_i >> perm[i] & 1:
+            continue
+        for j in range(n):
+            if j != i and not mask_i >> perm[j] & 1 \
+                    and not restrictions_mask[j] >> perm[i] & 1:
+                perm[i], perm[j] = perm[j], perm[i]
+                break
+        else:
+            return False
 
+    return True
 
-def brute_force_draw(people: Set[Person]):
-    valid = False
-    while not valid:
-        valid = _brute_force_draw(people)
+
+def csp_draw(people: Set[Person], rng: random.Random = None) -> Set[Person]:
+    """Performs draw as a constraint satisfaction problem:
+    - Prunes candidate sets with arc-consistency style propagation
+    - Backtracks deterministically, always expanding the giver with the
+      fewest candidates left (minimum remaining values)
+    - Randomizes the found assignment with validity-preserving swaps
+    Unlike dfs_draw the result is any valid assignment, so it may consist of
+    several separate gift circles, but it also works when restrictions make a
+    single chain impossible.
+    :param people: People to be drawn
+    :param rng: Random generator to draw with, module default if None
+    :return: People with secret santa attribute assigned
+    """
+    if rng is None:
+        rng = _rng
+    persons, _, allowed = index_people(people)
+    candidates = list(allowed)
+    if not _propagate(candidates):
+        raise ValueError('Restrictions allow no valid draw')
+    perm = _mrv_assign(candidates)
+    if perm is None:
+        raise ValueError('Restrictions allow no valid draw')
+    _shuffle_assignment(perm, allowed, rng)
+
+    for giver, receiver in enumerate(perm):
+        persons[giver].secret_santa = persons[receiver]
 
     return people
 
 
-def _brute_force_draw(people: Set[Person]) -> bool:
-    not_selected = list(people)
-    for p in people:
-        ss = random.choice(not_selected)
-        if ss.name in {p.name} | set(p.restrictions):
-            return False
-        p.set_secret_santa(ss)
-        not_selected.remove(ss)
+def _propagate(candidates: List[int]) -> bool:
+    """ Prunes candidate masks with arc-consistency style propagation, in place
+    Two all-different rules are applied until a fixpoint: a giver with a single
+    candidate owns that receiver, and a receiver wanted by a single giver is
+    handed to them.
+    :param candidates: Bitmask of possible receivers per giver
+    :return: False if some giver or receiver runs out of options
+    """
+    n = len(candidates)
+    changed = True
+    while changed:
+        changed = False
+        for i, cand in enumerate(candidates):
+            if cand == 0:
+                return False
+            if cand & (cand - 1) == 0:
+                for q in range(n):
+                    if q != i and candidates[q] & cand:
+                        candidates[q] &= ~cand
+                        changed = True
+        for j in range(n):
+            bit = 1 << j
+            owners = [i for i in range(n) if candidates[i] & bit]
+            if not owners:
+                return False
+            if len(owners) == 1 and candidates[owners[0]] != bit:
+                candidates[owners[0]] = bit
+                changed = True
 
     return True
 
 
-def dfs_draw(people: Set[Person]) -> Set[Person]:
+def _mrv_assign(candidates: List[int]):
+    """ Finds a valid giver-to-receiver assignment by backtracking
+    The giver with the fewest remaining candidates is always expanded first, and
+    every tentative choice is propagated before recursing.
+    :param candidates: Bitmask of possible receivers per giver
+    :return: List mapping giver index to receiver index, or None if infeasible
+    """
+    unassigned = None
+    for i, cand in enumerate(candidates):
+        if cand & (cand - 1):
+            count = bin(cand).count('1')
+            if unassigned is None or count < unassigned[0]:
+                unassigned = (count, i)
+    if unassigned is None:
+        # Every giver is down to a single receiver
+        return [cand.bit_length() - 1 for cand in candidates]
+
+    giver = unassigned[1]
+    cand = candidates[giver]
+    while cand:
+        bit = cand & -cand
+        cand ^= bit
+        trial = list(candidates)
+        trial[giver] = bit
+        if _propagate(trial):
+            result = _mrv_assign(trial)
+            if result is not None:
+                return result
+
+    return None
+
+
+def _shuffle_assignment(perm: List[int], allowed: List[int], rng: random.Random):
+    """ Randomizes a valid assignment in place with validity-preserving swaps
+    :param perm: Permutation mapping giver index to receiver index
+    :param allowed: Bitmask of allowed receivers per giver
+    :param rng: Random generator to draw with
+    """
+    n = len(perm)
+    for _ in range(10 * n):
+        i = rng.randrange(n)
+        j = rng.randrange(n)
+        if allowed[i] >> perm[j] & 1 and allowed[j] >> perm[i] & 1:
+            perm[i], perm[j] = perm[j], perm[i]
+
+
+def dfs_draw(people: Set[Person], rng: random.Random = None) -> Set[Person]:
     """Performs draw using an algorithm based on Depth-First Search:
     - Selects next node to visit randomly
     - Bottom node should be able to link to top node
     :param people: People to be drawn
+    :param rng: Random generator to draw with, module default if None
     :return: People with secret santa attribute assigned
     """
-    top = tuple(people)[0]
+    if rng is None:
+        rng = _rng
+    persons, _, allowed_mask = index_people(people)
+    top = 0
     # Look for chain that visits all nodes and in which bottom node can link to top
-    not_selected = people.copy()
-    not_selected.remove(top)
-    get_secret_santa(current=top, top=top, not_selected=not_selected)
+    remaining = ((1 << len(persons)) - 1) ^ (1 << top)
+    chain = _dfs_kernel(current=top, top=top, remaining=remaining,
+                        allowed_mask=allowed_mask, no_good=set(), rng=rng)
+    if chain is not None:
+        for giver, receiver in zip(chain, chain[1:]):
+            persons[giver].secret_santa = persons[receiver]
+        persons[chain[-1]].secret_santa = persons[top]
 
     return people
 
@@ -180,55 +411,139 @@ def get_chain(people: Set[Person]) -> List[Person]:
         and first element is the secret santa of last element
     """
     chain = []
-    top = tuple(people)[0]
+    top = next(iter(people))
     current = top
-    while current.secret_santa != top:
+    # Counted loop instead of while: bounds the walk even on corrupt data, and
+    # the identity check skips equality dispatch. The early exit stays because
+    # some draws produce several circles and the chain is only top's circle.
+    for _ in range(len(people)):
         chain.append(current)
         current = current.secret_santa
-
-    chain.append(current)
+        if current is top:
+            break
 
     return chain
 
 
-def get_secret_santa(current: Person, top: Person, not_selected: Set[Person]):
-    """Function used for secret santa DFS algorithm
-    :param current: Person
-        Current node
-    :param top: Person
-        Top node
-    :param not_selected: set of Person
-        Set of "not selected so far" people
-    :return: Person or None
-        Person with secret santa assigned or None in case it is not possible to assign someone
+def _dfs_kernel(current: int, top: int, remaining: int,
+                allowed_mask: List[int], no_good: set, rng: random.Random):
+    """Iterative kernel of the secret santa DFS algorithm
+    Works purely on integers and bitmasks — no Person objects, attribute lookups
+    or strings in the hot path — and keeps its own stack of pending candidates
+    instead of recursing, so large draws cannot hit the interpreter recursion
+    limit.
+    :param current: int
+        Index of current node
+    :param top: int
+        Index of top node
+    :param remaining: int
+        Bitmask of "not selected so far" people
+    :param allowed_mask: list of int
+        Allowed-receiver bitmasks built by index_people
+    :param no_good: set
+        States (current, remaining) already known to be infeasible. Whether a state
+        can complete the chain does not depend on the path that led to it, so
+        infeasible states can be remembered and never explored twice.
+    :param rng: random.Random
+        Random generator to draw with
+    :return: list of int or None
+        Chain of indices starting at current, or None in case no chain is possible
     """
-    if not not_selected and top.name not in current.restrictions:
-        # We are at the end of the chain and top element can be assigned to current
-        current.set_secret_santa(top)
-        return current
-
-    possibilities = [i for i in not_selected if i.name not in current.restrictions]
-    random.shuffle(possibilities)
-    for pers in possibilities:
-        next_not_selected = not_selected.copy()
-        next_not_selected.remove(pers)
-        secret_santa = get_secret_santa(current=pers, top=top, not_selected=next_not_selected)
-        if secret_santa is not None:
-            current.set_secret_santa(secret_santa)
-            return current
+    chain = [current]
+    masks = [remaining]
+    if remaining == 0:
+        # Degenerate draw with a single person
+        return chain if allowed_mask[current] >> top & 1 else None
+
+    stack = [_possibilities(current, remaining, allowed_mask, rng)]
+    while stack:
+        options = stack[-1]
+        if not options:
+            # Every candidate of the node on top failed: backtrack
+            no_good.add((chain[-1], masks[-1]))
+            stack.pop()
+            chain.pop()
+            masks.pop()
+            continue
+
+        pers = options.pop()
+        next_remaining = masks[-1] ^ (1 << pers)
+        if (pers, next_remaining) in no_good:
+            continue
+        if not _forward_check(next_remaining, top, allowed_mask):
+            no_good.add((pers, next_remaining))
+            continue
+        if next_remaining == 0:
+            if allowed_mask[pers] >> top & 1:
+                # We are at the end of the chain and top can be assigned to pers
+                chain.append(pers)
+                return chain
+            no_good.add((pers, 0))
+            continue
+
+        chain.append(pers)
+        masks.append(next_remaining)
+        stack.append(_possibilities(pers, next_remaining, allowed_mask, rng))
 
     return None
 
 
+def _possibilities(current: int, remaining: int, allowed_mask: List[int],
+                   rng: random.Random) -> List[int]:
+    """ Returns the possible successors of current, meant to be popped from the end
+    Candidates are shuffled and then ordered fail-first, with the fewest onward
+    options at the tail of the list where the kernel pops first, so dead branches
+    are discovered close to the top of the tree. Ties stay in random order.
+    :param current: Index of current node
+    :param remaining: Bitmask of "not selected so far" people
+    :param allowed_mask: Allowed-receiver bitmasks built by index_people
+    :param rng: Random generator to draw with
+    :return: Candidate indices, best candidate last
+    """
+    candidates = remaining & allowed_mask[current]
+    possibilities = []
+    while candidates:
+        bit = candidates & -candidates
+        possibilities.append(bit.bit_length() - 1)
+        candidates ^= bit
+    rng.shuffle(possibilities)
+    possibilities.sort(
+        key=lambda i: bin((remaining ^ (1 << i)) & allowed_mask[i]).count('1'),
+        reverse=True)
+
+    return possibilities
+
+
+def _forward_check(remaining: int, top: int, allowed_mask: List[int]) -> bool:
+    """ Checks whether every not-yet-selected person can still get a successor
+    Each person in remaining must be able to link to another remaining person or,
+    as the last link of the chain, back to top. If someone has no option left the
+    branch is a dead end and can be pruned without descending into it.
+    :param remaining: Bitmask of "not selected so far" people
+    :param top: Index of top node
+    :param allowed_mask: Allowed-receiver bitmasks built by index_people
+    :return: False if some remaining person has no possible successor
+    """
+    top_bit = 1 << top
+    check = remaining
+    while check:
+        bit = check & -check
+        check ^= bit
+        if not ((remaining ^ bit) | top_bit) & allowed_mask[bit.bit_length() - 1]:
+            return False
+
+    return True
+
+
 def save_output(people: Set[Person], file_name: str):
     """ Saves draw result to file
     :param people: Set of People, with secret santa assigned
     :param file_name: Name of output file
     """
+    lines = [f'{pers.name}, {pers.email}, {pers.gender}, {pers.secret_santa}\n'
+             for pers in people]
     with open(file_name, 'w') as file_obj:
-        for pers in people:
-            file_obj.write('%s, %s, %s, %s\n'
-                           % (pers.name, pers.email, pers.gender, pers.secret_santa))
+        file_obj.write(''.join(lines))
 
 
 def main():
@@ -253,7 +568,7 @@ def main():
     if args.sender is not None:
         # Send emails
         people_list = list(people)
-        random.shuffle(people_list)
+        _rng.shuffle(people_list)
         msgs = Messages(
             sender=args.sender,
             msg_template=args.message_template,
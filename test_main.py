@@ -1,7 +1,7 @@
 """ Tests for main.py """
 import random
 import pytest
-from main import Person, dfs_draw, get_chain, brute_force_draw
+from main import Person, dfs_draw, get_chain, brute_force_draw, csp_draw
 
 
 @pytest.fixture
@@ -27,13 +27,12 @@ def two_groups():
     ]
 
 
-@pytest.mark.parametrize("algo", [dfs_draw, brute_force_draw])
+@pytest.mark.parametrize("algo", [dfs_draw, brute_force_draw, csp_draw])
 def test_multiple_runs(algo, few_restrictions):
     """ Tests multiple runs for different values of seed """
     people = few_restrictions
     for seed in range(1000):
-        random.seed(seed)
-        drafted = algo(people)
+        drafted = algo(people, rng=random.Random(seed))
         validate(drafted, people)
 
 